@@ -0,0 +1,29 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Optional compiled helpers for ls7366r. Build in place with:
+
+    cythonize -i _ls7366r_fast.pyx
+
+ls7366r falls back to pure Python if this module is not available."""
+
+cdef enum:
+    WRITE_DTR = 0x98
+
+cpdef int decode_cntr(resp, int nbytes) except? -1:
+    """Decode the last nbytes of an SPI response as a signed big endian
+       counter value."""
+    cdef Py_ssize_t i, n = len(resp)
+    cdef unsigned long long v = 0
+    cdef long long sign = 1LL << (8 * nbytes - 1)
+    for i in range(n - nbytes, n):
+        v = (v << 8) | <unsigned char>resp[i]
+    return <int>((<long long>v ^ sign) - sign)
+
+cpdef void encode_dtr(long long value, unsigned char[::1] out):
+    """Fill a 5 byte buffer with WRITE_DTR and the 32 bit value. The
+       caller masks value to 32 bits first."""
+    cdef unsigned long long v = <unsigned long long>value & 0xFFFFFFFFULL
+    out[0] = WRITE_DTR
+    out[1] = (v >> 24) & 0xFF
+    out[2] = (v >> 16) & 0xFF
+    out[3] = (v >> 8) & 0xFF
+    out[4] = v & 0xFF
@@ -20,6 +20,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import asyncio
+import ctypes
+import struct
+
+# Linux only, used by _write_frames() when the SPI object has a file
+# descriptor. Without it frames are written one call at a time.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Optional compiled counts decode/encode, see _ls7366r_fast.pyx
+try:
+    import _ls7366r_fast
+except ImportError:
+    _ls7366r_fast = None
+
 # MDR0 configuration data - the configuration byte is formed with
 # single segments taken from each group and ORing all together.
 
@@ -84,18 +101,91 @@ WRITE_MDR1 = 0x90
 WRITE_MDR0 = 0x88
 WRITE_DTR = 0x98
 LOAD_CNTR = 0xE0
-LOAD_OTR = 0xE4
+LOAD_OTR = 0xE8
+
+# The op-codes above are an operation ORed with a register
+CLR_REG = 0x00
+RD_REG = 0x40
+WR_REG = 0x80
+LOAD_REG = 0xC0
+REG_MDR0 = 0x08
+REG_MDR1 = 0x10
+REG_DTR = 0x18
+REG_CNTR = 0x20
+REG_OTR = 0x28
+REG_STR = 0x30
+
+# Linux spidev struct spi_ioc_transfer
+_SPI_IOC_TRANSFER = struct.Struct("=QQIIHBBBBBB")
+
+def _spi_ioc_message(n):
+    """Return the SPI_IOC_MESSAGE(n) ioctl request number."""
+    # 0x40000000 is the _IOC_WRITE direction bit as laid out on x86 and
+    # ARM. Other architectures (e.g. MIPS, PowerPC) encode it differently.
+    return 0x40000000 | (n * _SPI_IOC_TRANSFER.size) << 16 | ord('k') << 8
+
+def _decode_cntr_rows(raw, bits, out):
+    """Convert rows of raw big endian CNTR bytes, as a 2D uint8 array,
+       into signed counts stored in out. Only worth calling jitted."""
+    sign = 1 << (bits - 1)
+    for i in range(raw.shape[0]):
+        val = 0
+        for j in range(raw.shape[1]):
+            val = (val << 8) | int(raw[i, j])
+        out[i] = (val ^ sign) - sign
+
+# _decode_cntr_rows() compiled by Numba on first use, False if Numba is
+# not installed and None if not tried yet
+_decode_cntr_rows_jit = None
+
+def _get_decode_cntr_rows_jit():
+    """Return the jitted _decode_cntr_rows(), or None without Numba. Numba
+       is only imported here so importing this module stays cheap."""
+    global _decode_cntr_rows_jit
+    if _decode_cntr_rows_jit is None:
+        try:
+            from numba import njit
+        except ImportError:
+            _decode_cntr_rows_jit = False
+        else:
+            _decode_cntr_rows_jit = njit(cache=True)(_decode_cntr_rows)
+    return _decode_cntr_rows_jit or None
 
 class LS7366R():
     """LSI/CSI LS7366R quadrature counter."""
 
-    def __init__(self, spi):
-        # This should be a SpiDev or compatible object.
+    # Prebuilt fixed command frames
+    _CMD_LOAD_CNTR = bytes([LOAD_CNTR])
+
+    def __init__(self, spi, max_speed_hz=1000000):
+        # This should be a SpiDev (3.4 or later) or compatible object
+        # providing writebytes2() and xfer3(). It must already be open.
         self._spi = spi
 
-        # Default config
-        self._write_mdr0(QUADRX4 | FREE_RUN | DISABLE_INDX | FILTER_1)
-        self._write_mdr1(BYTE_4 | EN_CNTR)
+        # SPI mode 0, 8 bit words. The spidev default clock is often
+        # far below what the LS7366R can handle, so set it explicitly.
+        # The maximum SCK rate depends on the supply voltage. Take it from
+        # the SCK high/low pulse widths in the datasheet's timing table
+        # before raising max_speed_hz. The 1 MHz default is a conservative
+        # pick, not the datasheet max. Pass max_speed_hz=None to keep a
+        # clock already set on the SPI object.
+        self._spi.mode = 0
+        self._spi.bits_per_word = 8
+        if max_speed_hz is not None:
+            self._spi.max_speed_hz = max_speed_hz
+
+        # Shadows of MDR0 and MDR1. These are authoritative once the
+        # default config below is written; all config reads and
+        # read-modify-writes use them. See resync().
+        self._mdr0_cache = None
+        self._mdr1_cache = None
+
+        # Default config, both registers written in one ioctl
+        mdr0 = QUADRX4 | FREE_RUN | DISABLE_INDX | FILTER_1
+        mdr1 = BYTE_4 | EN_CNTR
+        self._write_frames(bytes([WRITE_MDR0, mdr0]), bytes([WRITE_MDR1, mdr1]))
+        self._mdr0_cache = mdr0
+        self._update_mdr1_cache(mdr1)
 
         # Set to zero at start
         self.counts = 0
@@ -103,107 +193,186 @@ class LS7366R():
     @property
     def counts(self):
         """Current counts as signed integer."""
-        return self._get_counts()
+        # Not using _read_register(), this is the polling hot path. The width
+        # and frame are always valid here since __init__ writes MDR1.
+        return self._decode(self._spi.xfer3(self._read_cntr_cmd))
 
     @counts.setter
     def counts(self, value):
-        self._set_counts(value)
+        # Masked here for both paths, so any int behaves the same whether
+        # or not the compiled helpers are available.
+        value &= 0xFFFFFFFF
+        frame = bytearray(5)
+        if _ls7366r_fast is not None:
+            _ls7366r_fast.encode_dtr(value, frame)
+        else:
+            frame[0] = WRITE_DTR
+            frame[1:] = value.to_bytes(4, 'big')
+        self._write_frames(frame, self._CMD_LOAD_CNTR)
+
+    async def counts_async(self):
+        """Read counts in the default executor so the blocking SPI transfer
+           can overlap other asyncio work. The thread hop costs more than
+           a fast transfer, so this only helps if there is work to overlap."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self.counts)
 
     @property
     def bits(self):
         """Counter bits."""
-        return COUNTER_BITS[self._read_mdr1()[0] & 0x03]
+        return COUNTER_BITS[self._mdr1_cache & 0x03]
 
     @bits.setter
     def bits(self, value):
         if value not in COUNTER_BITS:
             raise ValueError("Bits must be one of ", *COUNTER_BITS)
-        self._write_mdr1(self._read_mdr1()[0] &0xFC | COUNTER_BITS.index(value))
+        self._write_register(REG_MDR1,
+                             (self._mdr1_cache & 0xFC) | COUNTER_BITS.index(value))
 
     @property
     def quadrature(self):
         """Quadrature mode."""
-        return QUADRATURE_MODES[self._read_mdr0()[0] & 0x03]
+        return QUADRATURE_MODES[self._mdr0_cache & 0x03]
 
     @quadrature.setter
     def quadrature(self, value):
         if value not in QUADRATURE_MODES:
             raise ValueError("Mode must be one of ", *QUADRATURE_MODES)
-        self._write_mdr0((self._read_mdr0()[0] & 0xFC) | QUADRATURE_MODES.index(value))
-
-    def _get_counts(self, ):
-        """Read the counter register value."""      
-        bits = self.bits
-        byte_values = self._read_cntr()
-        counts = 0
-        for b in byte_values:
-            counts <<= 8
-            counts |= b
-        if counts >> (bits - 1):
-            counts -= 1 << bits
-        return counts
-
-    def _set_counts(self, value):
-        """Set the counter register value."""
-        self._write_dtr(value)
-        self._load_cntr()
-
-    def _clear_mdr0(self):
-        """Clear MDR0."""
-        self._spi.writebytes([CLR_MDR0])
-
-    def _clear_mdr1(self):
-        """Clear MDR1."""
-        self._spi.writebytes([CLR_MDR1])
-
-    def _clear_cntr(self):
-        """Clear the counter."""
-        self._spi.writebytes([CLR_CNTR])
-
-    def _clear_str(self):
-        """Clear the status register."""
-        self._spi.writebytes([CLR_STR])
-
-    def _read_mdr0(self):
-        """Read the 8 bit MDR0 register."""
-        return self._spi.xfer2([READ_MDR0, 0x00])[1:]
-
-    def _read_mdr1(self):
-        """Read the 8 bit MDR1 register."""
-        return self._spi.xfer2([READ_MDR1, 0x00])[1:]
-
-    def _read_cntr(self):
-        """Transfer CNTR to OTR, then read OTR. Size of return depends
-           on current bit setting."""
-        return self._spi.xfer2([READ_CNTR]+[0]*(self.bits//8))[1:]
-
-    def _read_otr(self):
-        """Output OTR."""
-        return self._spi.xfer2([READ_OTR]+[0]*(self.bits//8))[1:]
-
-    def _read_str(self):
-        """Read 8 bit STR register."""
-        return self._spi.xfer2([READ_STR,0x00])[1:]
-
-    def _write_mdr0(self, mode):
-        """Write serial data at MOSI into MDR0."""
-        self._spi.writebytes([WRITE_MDR0, mode])
-
-    def _write_mdr1(self, mode):
-        """Write serial data at MOSI into MDR1."""
-        self._spi.writebytes([WRITE_MDR1, mode])
-
-    def _write_dtr(self, value):
-        """Write to 32 bit DTR register."""
-        self._spi.writebytes([WRITE_DTR, value >> 24 & 0xFF,
-                                         value >> 16 & 0xFF,
-                                         value >>  8 & 0xFF,
-                                         value       & 0xFF])
-
-    def _load_cntr(self):
-        """Transfer DTR to CNTR."""
-        self._spi.writebytes([LOAD_CNTR])
-
-    def _load_otr(self):
-        """Transfer CNTR to OTR."""
-        self._spi.writebytes([LOAD_OTR])
+        self._write_register(REG_MDR0,
+                             (self._mdr0_cache & 0xFC) | QUADRATURE_MODES.index(value))
+
+    @property
+    def enabled(self):
+        """Counting enabled."""
+        return (self._mdr1_cache & DIS_CNTR) == 0
+
+    @enabled.setter
+    def enabled(self, state):
+        self._write_register(REG_MDR1, (self._mdr1_cache & ~DIS_CNTR & 0xFF) |
+                                       (EN_CNTR if state else DIS_CNTR))
+
+    @staticmethod
+    def read_all(devices):
+        """Read counts from several devices, e.g. one per axis. All the
+           counters are sampled first and decoded afterwards, keeping the
+           reads as close together in time as possible."""
+        resps = [(dev, dev._spi.xfer3(dev._read_cntr_cmd)) for dev in devices]
+        return [dev._decode(resp) for dev, resp in resps]
+
+    def resync(self):
+        """Re-read MDR0 and MDR1 from the chip into the shadows, e.g.
+           if something else may have written to it."""
+        self._read_register(REG_MDR0)
+        self._read_register(REG_MDR1)
+
+    def read_counts_batch(self, n):
+        """Read counts n times back to back. If Numba is installed and n
+           is more than 1, the samples are decoded in one jitted pass and
+           returned as an int32 NumPy array. Otherwise they are decoded
+           with the scalar path and returned as a list."""
+        cmd = self._read_cntr_cmd
+        kernel = _get_decode_cntr_rows_jit() if n > 1 else None
+        if kernel is None:
+            resps = [self._spi.xfer3(cmd) for _ in range(n)]
+            return [self._decode(resp) for resp in resps]
+        import numpy as np
+        size = len(cmd)
+        buf = bytearray(n * size)
+        for i in range(0, n * size, size):
+            buf[i:i+size] = self._spi.xfer3(cmd)
+        # Opcode column dropped as a view, not a copy
+        raw = np.frombuffer(buf, dtype=np.uint8).reshape(n, size)[:, 1:]
+        out = np.empty(n, dtype=np.int32)
+        kernel(raw, self._bits, out)
+        return out
+
+    def _decode(self, resp):
+        """Signed counts from a full CNTR read response. The opcode byte
+           is masked off instead of slicing the response, then the value
+           is sign extended without branching."""
+        if _ls7366r_fast is not None:
+            return _ls7366r_fast.decode_cntr(resp, self._nbytes)
+        raw = int.from_bytes(resp, 'big')
+        return ((raw & self._wrap_mask) ^ self._sign_bit) - self._sign_bit
+
+    def _write_frames(self, *frames):
+        """Write each frame as its own CS cycle, in a single ioctl if the
+           SPI object exposes a spidev file descriptor. The LS7366R only
+           acts on an instruction when CS goes high, so frames can not
+           simply be concatenated."""
+        try:
+            fd = self._spi.fileno()
+        except AttributeError:
+            fd = None
+        if fd is None or fcntl is None:
+            for frame in frames:
+                self._spi.writebytes2(frame)
+            return
+        # A bytearray frame is used as the transfer buffer as is, so the
+        # DTR frame encoded by the counts setter is never copied.
+        bufs = [(ctypes.c_char * len(frame)).from_buffer(frame)
+                if isinstance(frame, bytearray) else
+                ctypes.create_string_buffer(bytes(frame), len(frame))
+                for frame in frames]
+        msg = bytearray()
+        for i, buf in enumerate(bufs):
+            cs_change = int(i < len(bufs) - 1)
+            msg += _SPI_IOC_TRANSFER.pack(ctypes.addressof(buf), 0, len(buf),
+                                          0, 0, 0, cs_change, 0, 0, 0, 0)
+        fcntl.ioctl(fd, _spi_ioc_message(len(bufs)), msg)
+
+    def _sizeof_register(self, reg):
+        """Size of a register in bytes."""
+        return self._reg_size[reg]
+
+    def _shadow_register(self, reg, value):
+        """Keep the MDR0/MDR1 shadows in step with a register access."""
+        if reg == REG_MDR0:
+            self._mdr0_cache = value & 0xFF
+        elif reg == REG_MDR1:
+            self._update_mdr1_cache(value)
+
+    def _update_mdr1_cache(self, mode):
+        """Update the MDR1 shadow along with the counter width and the
+           register sizes and read frames that depend on it."""
+        self._mdr1_cache = mode & 0xFF
+        self._bits = COUNTER_BITS[mode & 0x03]
+        self._nbytes = self._bits // 8
+        self._wrap_mask = (1 << self._bits) - 1
+        self._sign_bit = 1 << (self._bits - 1)
+        self._reg_size = {REG_MDR0: 1, REG_MDR1: 1, REG_STR: 1,
+                          REG_DTR: self._nbytes,
+                          REG_CNTR: self._nbytes,
+                          REG_OTR: self._nbytes}
+        self._reg_mask = {reg: (1 << 8 * size) - 1
+                          for reg, size in self._reg_size.items()}
+        self._read_cmd = {reg: bytes([RD_REG | reg]) + bytes(size)
+                          for reg, size in self._reg_size.items()}
+        self._read_cntr_cmd = self._read_cmd[REG_CNTR]
+
+    def _clear_register(self, reg):
+        """Clear MDR0, MDR1, CNTR or STR. Low level access, not used by
+           the driver itself."""
+        self._spi.writebytes2(bytes([CLR_REG | reg]))
+        self._shadow_register(reg, 0)
+
+    def _read_register(self, reg):
+        """Read a register as an unsigned integer. Reading CNTR also
+           transfers it to OTR."""
+        # The whole response is decoded, the mask drops the op-code byte
+        resp = self._spi.xfer3(self._read_cmd[reg])
+        value = int.from_bytes(resp, 'big') & self._reg_mask[reg]
+        self._shadow_register(reg, value)
+        return value
+
+    def _write_register(self, reg, value):
+        """Write an unsigned integer to MDR0, MDR1 or DTR."""
+        size = self._sizeof_register(reg)
+        value &= self._reg_mask[reg]
+        self._spi.writebytes2(bytes([WR_REG | reg]) + value.to_bytes(size, 'big'))
+        self._shadow_register(reg, value)
+
+    def _load_register(self, reg):
+        """Transfer DTR to CNTR, or CNTR to OTR. Low level access, not
+           used by the driver itself."""
+        self._spi.writebytes2(bytes([LOAD_REG | reg]))
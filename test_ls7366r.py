@@ -0,0 +1,248 @@
+import asyncio
+import ctypes
+import struct
+import sys
+
+import pytest
+
+import ls7366r
+
+
+class MockSPI():
+    """Frame level model of an LS7366R behind a SpiDev."""
+
+    def __init__(self):
+        self.mdr0 = self.mdr1 = self.dtr = self.cntr = self.otr = self.str_ = 0
+        self.transfers = 0
+
+    def _nbytes(self):
+        return 4 - (self.mdr1 & 0x03)
+
+    def _frame(self, data):
+        self.transfers += 1
+        data = list(data)
+        op, reg = data[0] & 0xC0, data[0] & 0x38
+        nbytes = self._nbytes()
+        mask = (1 << 8 * nbytes) - 1
+        # MISO is undefined while the op-code is shifted in
+        resp = [0xA5] + [0] * (len(data) - 1)
+        if op == ls7366r.RD_REG:
+            if reg == ls7366r.REG_CNTR:
+                self.otr = self.cntr
+            value, size = {ls7366r.REG_MDR0: (self.mdr0, 1),
+                           ls7366r.REG_MDR1: (self.mdr1, 1),
+                           ls7366r.REG_DTR: (self.dtr, nbytes),
+                           ls7366r.REG_CNTR: (self.cntr, nbytes),
+                           ls7366r.REG_OTR: (self.otr, nbytes),
+                           ls7366r.REG_STR: (self.str_, 1)}[reg]
+            resp[1:1 + size] = (value & ((1 << 8 * size) - 1)).to_bytes(size, 'big')
+        elif op == ls7366r.WR_REG:
+            value = int.from_bytes(bytes(data[1:]), 'big')
+            if reg == ls7366r.REG_MDR0:
+                self.mdr0 = value & 0xFF
+            elif reg == ls7366r.REG_MDR1:
+                self.mdr1 = value & 0xFF
+            elif reg == ls7366r.REG_DTR:
+                self.dtr = value & mask
+        elif op == ls7366r.LOAD_REG:
+            if reg == ls7366r.REG_CNTR:
+                self.cntr = self.dtr
+            elif reg == ls7366r.REG_OTR:
+                self.otr = self.cntr
+        elif reg == ls7366r.REG_MDR0:
+            self.mdr0 = 0
+        elif reg == ls7366r.REG_MDR1:
+            self.mdr1 = 0
+        elif reg == ls7366r.REG_CNTR:
+            self.cntr = 0
+        elif reg == ls7366r.REG_STR:
+            self.str_ = 0
+        return resp
+
+    def writebytes2(self, data):
+        self._frame(data)
+
+    def xfer3(self, data):
+        return tuple(self._frame(data))
+
+
+def edge_values(bits):
+    top = 1 << (bits - 1)
+    return (0, 1, -1, 5, -5, top - 1, -top)
+
+
+@pytest.fixture
+def spi():
+    return MockSPI()
+
+
+@pytest.fixture
+def dev(spi):
+    return ls7366r.LS7366R(spi)
+
+
+@pytest.mark.parametrize("bits", ls7366r.COUNTER_BITS)
+def test_counts(dev, bits):
+    dev.bits = bits
+    assert dev.bits == bits
+    for value in edge_values(bits):
+        dev.counts = value
+        assert dev.counts == value
+
+
+@pytest.mark.parametrize("bits", ls7366r.COUNTER_BITS)
+def test_read_counts_batch_numba(dev, bits, monkeypatch):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("numba")
+    monkeypatch.setattr(ls7366r, "_decode_cntr_rows_jit", None)
+    dev.bits = bits
+    for value in edge_values(bits):
+        dev.counts = value
+        counts = dev.read_counts_batch(3)
+        assert isinstance(counts, np.ndarray)
+        assert list(counts) == [value] * 3
+    # Single reads skip the kernel
+    assert dev.read_counts_batch(1) == [value]
+
+
+@pytest.mark.parametrize("bits", ls7366r.COUNTER_BITS)
+def test_read_counts_batch_without_numba(dev, bits, monkeypatch):
+    monkeypatch.setitem(sys.modules, "numba", None)
+    monkeypatch.setattr(ls7366r, "_decode_cntr_rows_jit", None)
+    dev.bits = bits
+    for value in edge_values(bits):
+        dev.counts = value
+        assert dev.read_counts_batch(3) == [value] * 3
+
+
+def test_registers(dev, spi):
+    dev.counts = 0x01020304
+    assert dev._read_register(ls7366r.REG_CNTR) == 0x01020304
+    assert dev._read_register(ls7366r.REG_OTR) == 0x01020304
+    dev._clear_register(ls7366r.REG_CNTR)
+    assert dev.counts == 0
+    dev._write_register(ls7366r.REG_DTR, 77)
+    dev._load_register(ls7366r.REG_CNTR)
+    assert dev.counts == 77
+    spi.cntr = 42
+    dev._load_register(ls7366r.REG_OTR)
+    assert dev._read_register(ls7366r.REG_OTR) == 42
+    spi.mdr1 = ls7366r.BYTE_2
+    spi.mdr0 = ls7366r.QUADRX1
+    dev.resync()
+    assert dev.bits == 16 and dev.quadrature == 1
+
+
+def test_read_all(dev):
+    other = ls7366r.LS7366R(MockSPI())
+    other.bits = 16
+    dev.counts = 123456
+    other.counts = -42
+    assert ls7366r.LS7366R.read_all([dev, other]) == [123456, -42]
+
+
+def test_counts_async_uses_subclass(spi):
+    class Offset(ls7366r.LS7366R):
+        counts = property(lambda self: ls7366r.LS7366R.counts.fget(self) + 1000,
+                          ls7366r.LS7366R.counts.fset)
+
+    dev = Offset(spi)
+    assert asyncio.run(dev.counts_async()) == 1000
+
+
+@pytest.mark.parametrize("value", [2**32 - 1, 2**64 - 1, -2**64 - 1])
+def test_counts_masks_wide_values(dev, value):
+    dev.counts = value
+    assert dev.counts == ((value & 0xFFFFFFFF) ^ 2**31) - 2**31
+
+
+def test_write_frames_ioctl(spi, monkeypatch):
+    if ls7366r.fcntl is None:
+        pytest.skip("no fcntl on this platform")
+    dev = ls7366r.LS7366R(spi)
+    calls = []
+
+    def ioctl(fd, request, msg):
+        # The transfer buffers only live for the duration of the call
+        xfers = [struct.unpack("=QQIIHBBBBBB", bytes(msg[i:i + 32]))
+                 for i in range(0, len(msg), 32)]
+        txs = [ctypes.string_at(xfer[0], xfer[2]) for xfer in xfers]
+        calls.append((fd, request, len(msg), xfers, txs))
+
+    monkeypatch.setattr(spi, "fileno", lambda: 7, raising=False)
+    monkeypatch.setattr(ls7366r.fcntl, "ioctl", ioctl)
+    frames = (bytearray([ls7366r.WRITE_DTR, 1, 2, 3, 4]),
+              bytes([ls7366r.LOAD_CNTR]))
+    dev._write_frames(*frames)
+
+    (fd, request, size, xfers, txs), = calls
+    assert fd == 7
+    assert request == 0x40406b00
+    assert size == 2 * 32
+    assert txs == list(frames)
+    for i, frame in enumerate(frames):
+        (tx_buf, rx_buf, length, speed_hz, delay_usecs, bits_per_word,
+         cs_change, tx_nbits, rx_nbits, word_delay_usecs, pad) = xfers[i]
+        assert rx_buf == 0
+        assert length == len(frame)
+        assert cs_change == int(i < len(frames) - 1)
+
+
+@pytest.mark.parametrize("bits", ls7366r.COUNTER_BITS)
+def test_fast_matches_python(spi, bits, monkeypatch):
+    fast = pytest.importorskip("_ls7366r_fast")
+    monkeypatch.setattr(ls7366r, "_ls7366r_fast", fast)
+    dev = ls7366r.LS7366R(spi)
+    dev.bits = bits
+    for value in edge_values(bits) + (2**32 - 1, 2**64 - 1):
+        dev.counts = value
+        frame = bytearray(5)
+        fast.encode_dtr(value & 0xFFFFFFFF, frame)
+        resp = spi.xfer3(dev._read_cntr_cmd)
+        with monkeypatch.context() as m:
+            m.setattr(ls7366r, "_ls7366r_fast", None)
+            expected = dev.counts
+            assert dev._decode(resp) == expected
+        assert bytes(frame) == (bytes([ls7366r.WRITE_DTR]) +
+                                (value & 0xFFFFFFFF).to_bytes(4, 'big'))
+        assert fast.decode_cntr(resp, bits // 8) == expected
+        assert dev.counts == expected
+
+
+def test_enabled(dev, spi):
+    dev.bits = 16
+    assert dev.enabled is True
+    dev.enabled = False
+    assert spi.mdr1 & ls7366r.DIS_CNTR
+    transfers = spi.transfers
+    assert dev.enabled is False
+    assert spi.transfers == transfers
+    assert dev.bits == 16
+    dev.enabled = True
+    assert not spi.mdr1 & ls7366r.DIS_CNTR
+    assert dev.enabled is True
+    assert spi.mdr1 == ls7366r.BYTE_2
+
+
+def test_quadrature(dev, spi):
+    upper = ls7366r.INDX_LOADC | ls7366r.FILTER_2
+    dev._write_register(ls7366r.REG_MDR0, upper | ls7366r.QUADRX4)
+    transfers = spi.transfers
+    for mode, bits in zip(ls7366r.QUADRATURE_MODES,
+                          (ls7366r.NQUAD, ls7366r.QUADRX1,
+                           ls7366r.QUADRX2, ls7366r.QUADRX4)):
+        dev.quadrature = mode
+        assert dev.quadrature == mode
+        assert spi.mdr0 == upper | bits
+    # One write per change, no read back
+    assert spi.transfers == transfers + len(ls7366r.QUADRATURE_MODES)
+    with pytest.raises(ValueError):
+        dev.quadrature = 3
+
+
+def test_spi_settings(spi):
+    spi.max_speed_hz = 123
+    ls7366r.LS7366R(spi, max_speed_hz=None)
+    assert (spi.mode, spi.bits_per_word, spi.max_speed_hz) == (0, 8, 123)
+    ls7366r.LS7366R(spi)
+    assert spi.max_speed_hz == 1000000